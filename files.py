@@ -28,13 +28,25 @@ __email__ = 'daniel@destevez.net'
 
 
 import struct
+import re
 import xml.etree.ElementTree as ET
 import math
 import hashlib
 import os.path
 import os
+import collections
 
 import binascii
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_CERT_LEN = struct.Struct('>H')
+_BLOCK_HEADER = struct.Struct('>IH')
+# Fields of the file description XML, which has a fixed and simple schema
+_XML_FIELD = re.compile(rb'<(id|path|hash|size|block_size|fec)>([^<&]*)</\1>')
+_XML_REQUIRED = {b'id', b'path', b'hash', b'size', b'block_size'}
 
 class FileService:
     """
@@ -43,7 +55,7 @@ class FileService:
     Gets packets from LDPRouter() and handles file reconstruction
     using the File() class
     """
-    __block_header_len = 6
+    __block_header_len = _BLOCK_HEADER.size
 
     def __init__(self, router, files_path):
         """
@@ -53,11 +65,13 @@ class FileService:
           router (LDPRouter): LDP router to get packets from
           files_path (str): path to save files to
         """
-        router.register(self.__description_packet, 0x69)
-        router.register(self.__block_packet, 0x18)
-        router.register(self.__fec_packet, 0xff)
-        router.register(self.__signaling_packet, 0x42)
-        router.register(self.__signaling_packet, 0x5a)
+        router.register_map({
+            0x69: self.__description_packet,
+            0x18: self.__block_packet,
+            0xff: self.__fec_packet,
+            0x42: self.__signaling_packet,
+            0x5a: self.__signaling_packet,
+        })
 
         self.__files = dict()
         self.__files_path = files_path
@@ -72,7 +86,7 @@ class FileService:
         Args:
           packet (LDP): the LDP packet to handle
         """
-        cert_len = struct.unpack('>H', packet.payload[0:2])[0]
+        cert_len = _CERT_LEN.unpack_from(packet.payload, 0)[0]
         cert = packet.payload[2:2+cert_len]
         signature_len = 256 # TODO: Deduce length from cert
         signature = packet.payload[2+cert_len:2+cert_len+signature_len]
@@ -92,8 +106,9 @@ class FileService:
         Args:
           packet (LDP): the LDP packet to handle
         """
-        file_id, block_number = struct.unpack('>IH', packet.payload[:self.__block_header_len])
-        block = packet.payload[self.__block_header_len:]
+        payload = memoryview(packet.payload)
+        file_id, block_number = _BLOCK_HEADER.unpack_from(payload, 0)
+        block = payload[self.__block_header_len:]
         if file_id in self.__files:
             f = self.__files[file_id]
             if f is not self.__last_file and self.__last_file and self.__last_file.maybe_reconstructable:
@@ -112,8 +127,9 @@ class FileService:
         Args:
           packet (LDP): the LDP packet to handle
         """
-        file_id, block_number = struct.unpack('>IH', packet.payload[:self.__block_header_len])
-        block = packet.payload[self.__block_header_len:]
+        payload = memoryview(packet.payload)
+        file_id, block_number = _BLOCK_HEADER.unpack_from(payload, 0)
+        block = payload[self.__block_header_len:]
         if file_id in self.__files:
             f = self.__files[file_id]
             f.push_fec(block, block_number)
@@ -137,12 +153,17 @@ class FileService:
         """
         f = self.__files[file_id]
         contents = f.reconstruct()
-        if not contents:
+        if contents is None:
             return
 
         path = os.path.join(self.__files_path, f.path)
-        os.makedirs(os.path.dirname(path), exist_ok = True)
-        out = open(os.path.join(self.__files_path, f.path), 'wb')
+        # The directory is usually there already, so only create it
+        # if opening the file fails
+        try:
+            out = open(path, 'wb')
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            out = open(path, 'wb')
         out.write(contents)
         out.close()
         del self.__files[file_id]
@@ -160,44 +181,107 @@ class File:
         Create new file
 
         Args:
-          xml (str): XML description of the file
+          xml (bytes): XML description of the file
         """
-        root = ET.fromstring(xml)
-        self.id = int(root.find('id').text)
-        self.path = root.find('path').text
-        self.hash = root.find('hash').text
-        self.size = int(root.find('size').text)
-        self.block_size = int(root.find('block_size').text)
+        fields = self.__parse_xml(xml)
+        self.id = int(fields['id'])
+        self.path = fields['path']
+        self.hash = fields['hash']
+        self.size = int(fields['size'])
+        self.block_size = int(fields['block_size'])
         self.blocks = math.ceil(self.size / self.block_size)
-        self.fec = root.find('fec')
+        self.fec = fields.get('fec')
         if self.fec != None:
-            self.fec = self.fec.text
             self.__fec_matrix = None
-        self.__blocks = [None] * self.blocks
+        # The block buffer is allocated by __allocate() when it is first
+        # needed, so announced files that are never received take no memory
+        self.__data = None
+        self.__received = bytearray(self.blocks)
+        self.__missing = self.blocks
         self.__fec_blocks = list()
+        self.__fec_received = 0
+        self.__hash = hashlib.sha256()
+        self.__hash_next = 0
+
+    def __allocate(self):
+        """
+        Allocate the buffer where the blocks are stored
+        """
+        # Blocks are stored back to back, with the padding of the last
+        # block set to 0xff as required for FEC decoding
+        self.__data = bytearray(b'\xff') * (self.blocks * self.block_size)
+        self.__view = memoryview(self.__data)
+        if np:
+            self.__blocks = np.frombuffer(self.__data, dtype=np.uint8).reshape(self.blocks, self.block_size)
+
+    def __parse_xml(self, xml):
+        """
+        Parse the XML description of a file
+
+        Returns a dictionary with the text of the fields. A regular
+        expression scan is tried first, falling back to ElementTree
+        for anything it cannot handle (such as entities, CDATA or
+        attributes). The scan takes the first occurrence of each
+        field at any depth, so descriptions where a field also
+        appears nested inside another element are not supported
+
+        Args:
+          xml (bytes or memoryview): XML description of the file
+        """
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+        else:
+            xml = bytes(xml)
+        fields = dict()
+        for tag, text in _XML_FIELD.findall(xml):
+            fields.setdefault(tag, text)
+        # a <fec> that the scan could not match must not be dropped
+        fec_missed = b'<fec' in xml and b'fec' not in fields
+        if _XML_REQUIRED <= fields.keys() and not fec_missed:
+            return {tag.decode(): text.decode('utf-8') for tag, text in fields.items()}
+
+        root = ET.fromstring(xml)
+        fields = dict()
+        for element in root:
+            fields.setdefault(element.tag, element.text)
+        return fields
 
     def push_block(self, block, n):
         """
         Push a new block into the file
 
         Args:
-          block (bytes): block contents
+          block (bytes or memoryview): block contents
           n (int): block number
         """
-        if not self.__blocks[n]:
-            self.__blocks[n] = block
+        if not self.__received[n]:
+            if self.__data is None:
+                self.__allocate()
+            block = block[:self.block_size]
+            start = n * self.block_size
+            self.__view[start:start + len(block)] = block
+            self.__received[n] = 1
+            self.__missing -= 1
+            if n == self.__hash_next:
+                self.__update_hash()
 
     def push_fec(self, block, n):
         """
         Push a new FEC block into the file
 
         Args:
-          block (bytes): block contents
+          block (bytes or memoryview): block contents
           n (int): block number
         """
+        # FEC repair XORs whole blocks, so anything else is unusable
+        if len(block) != self.block_size:
+            print('[File service] Discarding FEC block {} in {} with length {} instead of {}'.format(n, self.path, len(block), self.block_size))
+            return
         if (len(self.__fec_blocks) <= n):
             self.__fec_blocks.extend([None]*(n - len(self.__fec_blocks) + 1))
-        if self.__fec_blocks[n] and self.__fec_blocks[n] != block:
+        if self.__fec_blocks[n] is None:
+            self.__fec_received += 1
+        elif self.__fec_blocks[n] and self.__fec_blocks[n] != block:
             print('[File service] Overwriting FEC block {} in {} with a block having different contents'.format(n, self.path))
         self.__fec_blocks[n] = block
 
@@ -206,9 +290,9 @@ class File:
         """
         Indicates whether a reconstruction seems feasible
         """
-        blocks_received = self.blocks - self.__blocks.count(None)
+        blocks_received = self.blocks - self.__missing
         if self.fec:
-            blocks_received += len(self.__fec_blocks) - self.__fec_blocks.count(None)
+            blocks_received += self.__fec_received
         return blocks_received >= self.blocks
 
     @property
@@ -216,63 +300,132 @@ class File:
         """
         Indicates whether a reconstruction is possible
         """
-        return self.__blocks.count(None) == 0
+        return self.__missing == 0
 
     def reconstruct(self):
         """
         Try to reconstruct the file
 
-        Returns the file contents (as bytes) if successful, None if not successful
+        Returns the file contents (as a memoryview of the internal buffer,
+        which is not copied) if successful, None if not successful
         """
-        contents = []
+        if self.__data is None:
+            self.__allocate()
         if self.fec and self.fec.startswith('ldpc:'):
-            if not self.__fec_matrix:
-                fec_params = dict([tuple(kvp.split('=')) for kvp in self.fec[5:].split(',')])
-                self.__fec_matrix = self.__fec_init_matrix(fec_params)
-            blocks_remain = self.__blocks.count(None)
-            fec_indices = [i for i in range(len(self.__fec_blocks)) if self.__fec_blocks[i]]
-            while blocks_remain > 0:
-                blocks_repaired = 0
-                for fec_index in fec_indices[:]:
-                    row = self.__fec_matrix[fec_index]
-                    missing_indices = [i for i in row if not self.__blocks[i]]
-                    if len(missing_indices) > 1:
-                        continue
-                    fec_indices.remove(fec_index)
-                    if len(missing_indices) == 0:
-                        continue
-                    missing_index = missing_indices[0]
-                    accum = self.__fec_blocks[fec_index]
-                    for index in row:
-                        if index != missing_index:
-                            unpadded_size = min(self.block_size, self.size - self.block_size * index)
-                            symbol = self.__blocks[index][:unpadded_size] + b'\xff' * (self.block_size - unpadded_size)
-                            accum = bytes([accum[i] ^ symbol[i] for i in range(len(accum))])
-                    missing_unpadded_size = min(self.block_size, self.size - self.block_size * missing_index)
-                    self.__blocks[missing_index] = accum[:missing_unpadded_size]
-                    blocks_repaired += 1
-                    blocks_remain -= 1
-                if blocks_repaired == 0:
-                    print('Unable to reconstruct file {}'.format(self.path))
-                    return
-            contents = bytes().join(self.__blocks)
+            if self.__missing:
+                self.__fec_decode()
+            if self.__missing:
+                print('Unable to reconstruct file {}'.format(self.path))
+                return
         else: # No (supported) FEC
-            if None in self.__blocks:
+            if self.__missing:
                 print('Some blocks are missing. Cannot reconstruct file {}'.format(self.path))
                 return
-            contents = bytes().join(self.__blocks)
-
-        if len(contents) != self.size:
-            print('File length mismatch. Cannot reconstruct file {}'.format(self.path))
-            return
 
-        h = hashlib.sha256()
-        h.update(contents)
-        if h.hexdigest() != self.hash:
+        self.__update_hash()
+        if self.__hash.hexdigest() != self.hash:
             print('File sha256sum mismatch. Cannot reconstruct file {}'.format(self.path))
             return
 
-        return contents
+        return self.__view[:self.size]
+
+    def __fec_decode(self):
+        """
+        Recover missing blocks using the LDPC FEC blocks
+
+        Runs a peeling decoder: any FEC block whose row has a single
+        missing data block is used to recover it, which can in turn
+        leave other rows with a single missing block
+        """
+        if not self.__fec_matrix:
+            fec_params = dict([tuple(kvp.split('=')) for kvp in self.fec[5:].split(',')])
+            self.__fec_matrix = self.__fec_init_matrix(fec_params)
+            # Rows in which each column appears
+            self.__fec_col_rows = [[] for _ in range(self.blocks)]
+            for row, cols in enumerate(self.__fec_matrix):
+                for col in cols:
+                    self.__fec_col_rows[col].append(row)
+
+        # For each row, count of missing blocks and XOR of their
+        # indices, which is the missing index when there is only one
+        row_missing = [0] * len(self.__fec_matrix)
+        row_missing_xor = [0] * len(self.__fec_matrix)
+        ready = collections.deque()
+        for row, cols in enumerate(self.__fec_matrix):
+            for col in cols:
+                if not self.__received[col]:
+                    row_missing[row] += 1
+                    row_missing_xor[row] ^= col
+            if row_missing[row] == 1 and self.__has_fec(row):
+                ready.append(row)
+
+        while ready:
+            row = ready.popleft()
+            if row_missing[row] != 1:
+                continue
+            missing_index = row_missing_xor[row]
+            self.__repair_block(missing_index, self.__fec_blocks[row],
+                                [col for col in self.__fec_matrix[row] if col != missing_index])
+            self.__received[missing_index] = 1
+            self.__missing -= 1
+            for other in self.__fec_col_rows[missing_index]:
+                row_missing[other] -= 1
+                row_missing_xor[other] ^= missing_index
+                if row_missing[other] == 1 and self.__has_fec(other):
+                    ready.append(other)
+
+    def __has_fec(self, row):
+        """
+        Indicates whether the FEC block for a row has been received
+
+        Args:
+          row (int): row of the FEC matrix
+        """
+        return row < len(self.__fec_blocks) and bool(self.__fec_blocks[row])
+
+    def __repair_block(self, n, fec_block, indices):
+        """
+        Recover a missing block by XORing a FEC block with the other
+        data blocks in its row. The result is accumulated in place in
+        the slot of the missing block, so no temporary blocks are created
+
+        Args:
+          n (int): number of the missing block
+          fec_block (bytes): FEC block (always block_size long,
+            as checked by push_fec())
+          indices (list): indices of the other data blocks
+        """
+        start = n * self.block_size
+        end = start + self.block_size
+        if np:
+            accum = self.__blocks[n]
+            accum[:] = np.frombuffer(fec_block, dtype=np.uint8)
+            for index in indices:
+                np.bitwise_xor(accum, self.__blocks[index], out=accum)
+        else:
+            # Without NumPy, the blocks are XORed as big integers
+            accum = int.from_bytes(fec_block, 'big')
+            for index in indices:
+                block_start = index * self.block_size
+                accum ^= int.from_bytes(self.__view[block_start:block_start + self.block_size], 'big')
+            self.__view[start:end] = accum.to_bytes(self.block_size, 'big')
+        # Padding of the last block is kept at 0xff
+        if end > self.size:
+            self.__view[self.size:end] = b'\xff' * (end - self.size)
+
+    def __update_hash(self):
+        """
+        Feed the received blocks following the ones already hashed to
+        the SHA-256 hash, so that most of the hashing is done as blocks
+        arrive rather than on reconstruction
+        """
+        # The run of received blocks is hashed with a single update
+        end = self.__received.find(0, self.__hash_next)
+        if end == -1:
+            end = self.blocks
+        if end > self.__hash_next:
+            self.__hash.update(self.__view[self.__hash_next * self.block_size:min(end * self.block_size, self.size)])
+            self.__hash_next = end
 
     def __fec_init_matrix(self, params):
         """
@@ -285,52 +438,49 @@ class File:
         n = int(params['n'])
         n1 = int(params['N1'])
         seed = int(params['seed']) if 'seed' in params else 1
-        prng = self.__fec_prng(seed)
-        p_tbl = [ p % (n - k) for p in range(k * n1)]
-        matrix = [[] for _ in range(n - k)]
+        # Park-Miller random number generator state. The generator is
+        # inlined below, as this runs O(k * N1) times
+        value = seed
+        rows = n - k
+        size = k * n1
+        p_tbl = [p % rows for p in range(size)]
+        matrix = [[] for _ in range(rows)]
+        # Columns are added in increasing order, so a row already contains
+        # the current column iff it was the last one added to it
+        last_col = [-1] * rows
         t = 0
         for col in range(k):
             for h in range(n1):
                 i = t
-                while i < k * n1 and col in matrix[p_tbl[i]]:
+                while i < size and last_col[p_tbl[i]] == col:
                     i += 1
-                if i >= k * n1:
+                if i >= size:
                     while True:
-                        row = next(prng) % (n - k)
-                        if col not in matrix[row]:
+                        value = 16807 * value % 2147483647
+                        row = value % rows
+                        if last_col[row] != col:
                             break
-                    matrix[row].append(col)
                 else:
                     while True:
-                        p = next(prng) % (k * n1 - t) + t
-                        if col not in matrix[p_tbl[p]]:
+                        value = 16807 * value % 2147483647
+                        p = value % (size - t) + t
+                        row = p_tbl[p]
+                        if last_col[row] != col:
                             break
-                    matrix[p_tbl[p]].append(col)
                     p_tbl[p] = p_tbl[t]
                     t += 1
-        for row in range(n - k):
+                matrix[row].append(col)
+                last_col[row] = col
+        for row in range(rows):
             degree = len(matrix[row])
             if degree == 0:
-                col = next(prng) % k
-                matrix[row].append(col)
+                value = 16807 * value % 2147483647
+                matrix[row].append(value % k)
             if degree <= 1:
                 while True:
-                    col = next(prng) % k
+                    value = 16807 * value % 2147483647
+                    col = value % k
                     if col not in matrix[row]:
                         break
                 matrix[row].append(col)
         return matrix
-
-    def __fec_prng(self, seed):
-        """
-        Generate pseudo random numbers
-
-        Implementation of the Park-Miller random number generator
-
-        Args:
-          seed (int): Seed
-        """
-        value = seed
-        while True:
-            value = (7**5 * value) % (2**31 - 1)
-            yield value
@@ -28,12 +28,28 @@ import os
 import getopt
 import socket
 import struct
+import ctypes
+import ctypes.util
+import errno
 
 UDP_PORT = 10000
 # Use UDP_HOST = '0.0.0.0' if you want IPv4 only
 UDP_HOST = '::'
 
 BUFSIZE = 4096
+# Maximum number of frames to get with a single recvmmsg() call
+RECV_BATCH = 32
+# Linux value (recvmmsg() is only used on Linux)
+MSG_WAITFORONE = 0x10000
+# Socket receive buffer size, large enough to hold the frames that arrive
+# while a file is being reconstructed
+RCVBUF = 8 * 1024 * 1024
+# SO_RCVBUFFORCE is not exported by the socket module. 33 is its value
+# in the generic Linux ABI (alpha, parisc and sparc use other values)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', None)
+if SO_RCVBUFFORCE is None and sys.platform.startswith('linux') \
+  and not os.uname().machine.startswith(('alpha', 'parisc', 'sparc')):
+    SO_RCVBUFFORCE = 33
 
 opDefragmenter = protocols.OPDefragmenter()
 router = protocols.LDPRouter()
@@ -42,11 +58,14 @@ groundstationMac = None
 BROADCAST_MAC = b'\xff'*6
 ETHERTYPE = b'\x8f\xff'
 
+MAC_STRUCT = struct.Struct('B'*6)
+ETHERTYPE_STRUCT = struct.Struct('>H')
+
 def printMac(mac):
-    return ('%02x:'* 5 + '%02x') % struct.unpack('B'*6, mac)
+    return ('%02x:'* 5 + '%02x') % MAC_STRUCT.unpack(mac)
 
 def printEthertype(ethertype):
-    return hex(struct.unpack('>H', ethertype)[0])
+    return hex(ETHERTYPE_STRUCT.unpack(ethertype)[0])
 
 def processFrame(frame):
     global groundstationMac
@@ -61,7 +80,7 @@ def processFrame(frame):
         print('Receiving Ethernet frames from groundstation with MAC {}'.format(printMac(srcmac)))
         groundstationMac = srcmac
     try:
-        packet = opDefragmenter.push(protocols.OP(frame[14:]))
+        packet = opDefragmenter.push_fields(*protocols.parse_op(frame, 14))
     except ValueError:
         return
     if not packet:
@@ -73,6 +92,27 @@ def processFrame(frame):
         return
     router.route(packet)
 
+def setReceiveBuffer(s):
+    # SO_RCVBUFFORCE (needs CAP_NET_ADMIN) ignores net.core.rmem_max,
+    # which silently caps SO_RCVBUF
+    options = [socket.SO_RCVBUF]
+    if SO_RCVBUFFORCE is not None:
+        options.insert(0, SO_RCVBUFFORCE)
+    for option in options:
+        try:
+            s.setsockopt(socket.SOL_SOCKET, option, RCVBUF)
+            break
+        except OSError as msg:
+            error = msg
+    else:
+        print('Unable to set socket receive buffer size', error)
+        return
+    size = s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if size < RCVBUF:
+        print('Socket receive buffer is only {} bytes. Frames may be lost '
+              'while files are reconstructed. On Linux, raise net.core.rmem_max '
+              'to at least {}'.format(size, RCVBUF))
+
 def getSocket():
     s = None
     for res in socket.getaddrinfo(UDP_HOST, UDP_PORT, socket.AF_UNSPEC, socket.SOCK_DGRAM, 0,
@@ -83,6 +123,7 @@ def getSocket():
         except OSError as msg:
             print('Socket error', msg)
             continue
+        setReceiveBuffer(s)
         try:
             s.bind(sa)
         except OSError as msg:
@@ -92,6 +133,65 @@ def getSocket():
         break
     return s
 
+# struct msghdr and struct mmsghdr as laid out by Linux. Other systems
+# with recvmmsg() (such as FreeBSD) use a different layout
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+def getRecvmmsg():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                         ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+def receiveFrames(s):
+    recvmmsg = getRecvmmsg()
+    if not recvmmsg:
+        while True:
+            yield s.recv(BUFSIZE)
+
+    # Receive up to RECV_BATCH frames per system call using recvmmsg()
+    buffers = [bytearray(BUFSIZE) for _ in range(RECV_BATCH)]
+    views = [memoryview(b) for b in buffers]
+    iovecs = (iovec * RECV_BATCH)()
+    msgs = (mmsghdr * RECV_BATCH)()
+    for i in range(RECV_BATCH):
+        iovecs[i].iov_base = ctypes.addressof(ctypes.c_char.from_buffer(buffers[i]))
+        iovecs[i].iov_len = BUFSIZE
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    while True:
+        n = recvmmsg(s.fileno(), msgs, RECV_BATCH, MSG_WAITFORONE, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        for i in range(n):
+            # Buffers are reused, so frames must be copied out (once)
+            yield views[i][:msgs[i].msg_len].tobytes()
+
 def usage():
     print('Usage: {} [OPTIONS]'.format(sys.argv[0]))
     print('')
@@ -149,15 +249,14 @@ def main():
 
     if kissinput:
         kissFile = open(kissinput, 'rb')
-        kissDeframer = kiss.KISSDeframer()
-        frames = kissDeframer.push(kissFile.read())
-        for frame in frames:
+        for frame in kiss.iter_frames(kissFile):
             processFrame(frame)
     else:
         s = getSocket()
+        frames = receiveFrames(s)
         while True:
             try:
-                frame = s.recv(BUFSIZE)
+                frame = next(frames)
             except KeyboardInterrupt:
                 print('')
                 sys.exit()
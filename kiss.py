@@ -23,24 +23,25 @@ __license__ = 'GPLv3'
 __maintainer__ = 'Daniel Estevez'
 __email__ = 'daniel@destevez.net'
 
-import collections
+import mmap
 
 class KISSDeframer():
     """
     Deframe a stream of bytes into KISS frames
     """
-    __FEND = 0xc0
-    __FESC = 0xdb
-    __TFEND = 0xdc
-    __TFESC = 0xdd
+    __FEND = b'\xc0'
+    __FESC = b'\xdb'
+    __TFEND = b'\xdc'
+    __TFESC = b'\xdd'
+    # escaped sequences for FEND and FESC
+    __ESC_FEND = __FESC + __TFEND
+    __ESC_FESC = __FESC + __TFESC
 
     def __init__(self):
         """
         Initialize KISS deframer
         """
-        self.__kiss = collections.deque()
-        self.__pdu = bytearray()
-        self.__transpose = False
+        self.__residual = bytes()
 
     def push(self, data):
         """
@@ -49,28 +50,72 @@ class KISSDeframer():
         Returns a list of the frames that have being
         successfully deframed (in the same order as in the stream)
 
+        Args:
+          data (bytes): the chunk of bytes to push (any buffer
+            with a find() method, such as bytearray, can be used)
+        """
+        return list(self.iter_push(data))
+
+    def iter_push(self, data):
+        """
+        Push a chunk of data bytes into the deframer
+
+        Same as push(), but yields the frames as they are deframed,
+        so that a large chunk (such as a memory-mapped file) can be
+        pushed without holding all its frames in memory. The generator
+        must be exhausted for the deframer state to be updated
+
         Args:
           data (bytes): the chunk of bytes to push
         """
-        pdus = list()
+        # FENDs are searched with find() and frames are unescaped with
+        # bytes methods, which run in C instead of byte by byte.
+        # The chunk is never copied as a whole: only the incomplete
+        # frame at the end is kept for the next push
+        residual = self.__residual
+        start = 0
+        while True:
+            end = data.find(self.__FEND, start)
+            if end < 0:
+                break
+            frame = data[start:end]
+            if residual:
+                frame = residual + frame
+                residual = bytes()
+            start = end + 1
+            if not frame:
+                continue
+            frame = frame.replace(self.__ESC_FEND, self.__FEND)\
+                         .replace(self.__ESC_FESC, self.__FESC)
+            if not frame[0] & 0x0f:
+                yield frame[1:]
+        self.__residual = residual + data[start:]
 
-        self.__kiss.extend(data)
+def iter_frames(f, chunksize = 1 << 20):
+    """
+    Read KISS frames from a file
 
-        while self.__kiss:
-            c = self.__kiss.popleft()
-            if c == self.__FEND:
-                if self.__pdu and not self.__pdu[0] & 0x0f:
-                    pdus.append(bytes(self.__pdu[1:]))
-                self.__pdu = bytearray()
-            elif self.__transpose:
-                if c == self.__TFEND:
-                    self.__pdu.append(self.__FEND)
-                elif c == self.__TFESC:
-                    self.__pdu.append(self.__FESC)
-                self.__transpose = False
-            elif c == self.__FESC:
-                self.__transpose = True
-            else:
-                self.__pdu.append(c)
+    Yields the frames in the file. Regular files are memory-mapped,
+    and other files (pipes, empty files...) are read in chunks, so that
+    the file is never loaded in memory at once
+
+    Args:
+      f (file): file opened in binary mode
+      chunksize (int): size of the chunks to read if the file cannot
+        be memory-mapped
+    """
+    deframer = KISSDeframer()
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        mapped = None
+    if mapped is not None:
+        with mapped:
+            yield from deframer.iter_push(mapped)
+        return
 
-        return pdus
+    while True:
+        chunk = f.read(chunksize)
+        if not chunk:
+            break
+        yield from deframer.push(chunk)
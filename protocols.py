@@ -26,8 +26,46 @@ __email__ = 'daniel@destevez.net'
 
 
 import struct
+import zlib
+import functools
 import zfec
-from crcmod.predefined import PredefinedCrc
+
+# LDP uses CRC-32/MPEG-2, which is CRC-32 without bit reflection and
+# without final XOR. It is computed with zlib.crc32() on the data with the
+# bits of each byte reversed: the CRC register then holds the bit
+# reversed CRC-32/MPEG-2, so a valid packet (residue 0) gives 0xffffffff
+_BIT_REVERSE = bytes(int('{:08b}'.format(b)[::-1], 2) for b in range(256))
+
+_OP_HEADER = struct.Struct('>HBBBB')
+_LDP_HEADER = struct.Struct('>L')
+
+@functools.lru_cache(maxsize=32)
+def _fec_decoder(k, n):
+    """
+    Get a zfec decoder, cached as the same (k, n) are used over and over
+    """
+    return zfec.Decoder(k, n)
+
+def parse_op(data, offset=0):
+    """
+    Parse an OP packet without creating an OP object
+
+    Returns a tuple (length, fragment_type, carousel_id, last_fragment,
+    fragment_index, payload), where payload is a memoryview into data
+
+    Args:
+      data (bytes): buffer containing the packet
+      offset (int): position of the packet in the buffer
+
+    Throws ValueError if packet is malformed
+    """
+    mv = data if isinstance(data, memoryview) else memoryview(data)
+    if len(mv) - offset < _OP_HEADER.size:
+        raise ValueError('Malformed OP packet: too short')
+
+    fields = _OP_HEADER.unpack_from(mv, offset)
+    start = offset + _OP_HEADER.size
+    return fields + (mv[start : start + fields[0] - 4],)
 
 class OP:
     """
@@ -35,8 +73,6 @@ class OP:
 
     OP is the L3 protocol of Outernet
     """
-    __header_len = 6
-
     def __init__(self, data):
         """
         Create OP packet
@@ -47,14 +83,8 @@ class OP:
 
         Throws ValueError if packet is malformed
         """
-
-        header = data[:self.__header_len]
-        if len(header) < self.__header_len:
-            raise ValueError('Malformed OP packet: too short')
-
         self.length, self.fragment_type, self.carousel_id, \
-          self.last_fragment, self.fragment_index = struct.unpack('>HBBBB', header)
-        self.payload = data[self.__header_len : self.__header_len + self.length - 4]
+          self.last_fragment, self.fragment_index, self.payload = parse_op(data)
 
 class PartialLDP:
     """
@@ -69,7 +99,9 @@ class PartialLDP:
     Reset the internal state
     """
     def reset(self):
-        self.__fragments = {}
+        # fragments indexed by share number (FEC blocks go after the data
+        # fragments), None for the ones not received yet
+        self.__fragments = []
         self.__frag_recv = 0
         self.__fec_recv = 0
         self.frag_size = None
@@ -85,10 +117,8 @@ class PartialLDP:
       payload (bytes): the actual data
     """
     def push_data(self, index, payload):
-        if index in self.__fragments:
-            return
-        self.__fragments[index] = payload
-        self.__frag_recv += 1
+        if self.__store(index, payload):
+            self.__frag_recv += 1
 
     """
     Push a FEC block
@@ -98,10 +128,22 @@ class PartialLDP:
       payload (bytes): the actual FEC data
     """
     def push_fec(self, index, payload):
-        if not self.frag_count or (self.frag_count + index) in self.__fragments:
-            return
-        self.__fragments[self.frag_count + index] = payload
-        self.__fec_recv += 1
+        if self.frag_count and self.__store(self.frag_count + index, payload):
+            self.__fec_recv += 1
+
+    def __store(self, sharenum, payload):
+        """
+        Store a block unless it was already received
+
+        Returns True if the block is new
+        """
+        fragments = self.__fragments
+        if sharenum >= len(fragments):
+            fragments.extend([None] * (sharenum + 1 - len(fragments)))
+        elif fragments[sharenum] is not None:
+            return False
+        fragments[sharenum] = payload
+        return True
 
     """
     Indicates whether a reconstruction is possible
@@ -115,11 +157,11 @@ class PartialLDP:
     """
     def decode(self):
         if self.__frag_recv == self.frag_count: # No error FEC decoding necessary
-            return b''.join([self.__fragments[s] for s in range(self.frag_count)])
+            return b''.join(self.__fragments[:self.frag_count])
         k = self.frag_count
         n = k + self.fec_count
-        decoder = zfec.Decoder(k, n)
-        sharenums = list(self.__fragments.keys())
+        decoder = _fec_decoder(k, n)
+        sharenums = [s for s, f in enumerate(self.__fragments) if f is not None]
         if len(sharenums) != k:
             print("[ERROR] Unexpected number of fragments. k = {}, sharenums = {}".format(k, sharenums))
             return
@@ -149,38 +191,54 @@ class OPDefragmenter:
         Args:
           packet (OP): Packet to push
         """
-        ldp = self.__pending.get(packet.carousel_id)
+        return self.push_fields(packet.length, packet.fragment_type, packet.carousel_id,
+                                packet.last_fragment, packet.fragment_index, packet.payload)
+
+    def push_fields(self, length, fragment_type, carousel_id, last_fragment, fragment_index, payload):
+        """
+        Push the fields of a new packet into defragmenter
+
+        Same as push(), but taking the fields as returned by parse_op(),
+        so that no OP object needs to be created
+
+        Returns a payload (bytes) if defragmentation is succesful,
+        None otherwise
+        """
+        ldp = self.__pending.get(carousel_id)
         if not ldp:
             ldp = PartialLDP()
-            self.__pending[packet.carousel_id] = ldp
+            self.__pending[carousel_id] = ldp
 
-        if packet.fragment_type == 0x3c or packet.fragment_type == 0xc3:
-            if packet.fragment_type == 0x3c and packet.fragment_index == 0: # TODO Verify correctness
-                return packet.payload
-            if packet.fragment_index < ldp.next_index:
+        if fragment_type == 0x3c or fragment_type == 0xc3:
+            if fragment_type == 0x3c and fragment_index == 0: # TODO Verify correctness
+                return payload
+            if fragment_index < ldp.next_index:
                 ldp.reset()
             if not ldp.frag_size:
-                ldp.frag_size = packet.length - 4
+                ldp.frag_size = length - 4
             if not ldp.frag_count:
-                ldp.frag_count = packet.last_fragment + 1
-            ldp.next_index = packet.fragment_index + 1
-            ldp.push_data(packet.fragment_index, packet.payload + b'\xff' * (ldp.frag_size - len(packet.payload)))
-            if packet.fragment_type == 0x3c and ldp.complete:
+                ldp.frag_count = last_fragment + 1
+            ldp.next_index = fragment_index + 1
+            padding = ldp.frag_size - len(payload)
+            if padding > 0:
+                payload = bytes(payload) + b'\xff' * padding
+            ldp.push_data(fragment_index, payload)
+            if fragment_type == 0x3c and ldp.complete:
                 decoded = ldp.decode()
                 ldp.reset()
                 return decoded
-        elif packet.fragment_type == 0x69:
+        elif fragment_type == 0x69:
             if not ldp.frag_size:
                 return
             if not ldp.fec_count:
-                ldp.fec_count = packet.last_fragment + 1
-            ldp.push_fec(packet.fragment_index, packet.payload)
+                ldp.fec_count = last_fragment + 1
+            ldp.push_fec(fragment_index, payload)
             if ldp.complete:
                 decoded = ldp.decode()
                 ldp.reset()
                 return decoded
         else:
-            print('Unsupported fragment type: {:02x}'.format(packet.fragment_type))
+            print('Unsupported fragment type: {:02x}'.format(fragment_type))
 
 class LDP:
     """
@@ -188,7 +246,7 @@ class LDP:
 
     LDP is the L4 protocol of Outernet
     """
-    __header_len = 4
+    __header_len = _LDP_HEADER.size
     __checksum_len = 4
 
     def __init__(self, data):
@@ -201,20 +259,20 @@ class LDP:
 
         Throws ValueError if packet is malformed
         """
-        if len(data) < self.__header_len + self.__checksum_len:
+        mv = data if isinstance(data, memoryview) else memoryview(data)
+        if len(mv) < self.__header_len + self.__checksum_len:
             raise ValueError('Malformed LDP packet: too short')
-        header = struct.unpack('>L', data[:self.__header_len])[0]
+        header = _LDP_HEADER.unpack_from(mv, 0)[0]
         self.type = header >> 24
         self.length = header & 0xffffff
-        if self.length > len(data):
+        if self.length > len(mv):
             raise ValueError('Malformed LDP packet: invalid length')
 
-        crc = PredefinedCrc('crc-32-mpeg')
-        crc.update(data[:self.length])
-        if crc.crcValue != 0:
+        if zlib.crc32(bytes(mv[:self.length]).translate(_BIT_REVERSE)) != 0xffffffff:
             raise ValueError('Malformed LDP packet: invalid checksum')
 
-        self.payload = data[self.__header_len:self.length-self.__checksum_len]
+        # payload is a memoryview, so that no copy is made here
+        self.payload = mv[self.__header_len:self.length-self.__checksum_len]
 
 class LDPRouter:
     """
@@ -228,7 +286,8 @@ class LDPRouter:
         """
         Create a new LDP router
         """
-        self.__registrations = dict()
+        # packet handlers, indexed by the 8 bit packet type
+        self.__registrations = [self.__unknown] * 256
 
     def route(self, packet):
         """
@@ -238,10 +297,13 @@ class LDPRouter:
         Args:
           packet (LDP): packet to route
         """
-        if packet.type not in self.__registrations:
-            print('Unknown routing for packet with type {:02x}'.format(packet.type))
-        else:
-            self.__registrations[packet.type](packet)
+        self.__registrations[packet.type](packet)
+
+    def __unknown(self, packet):
+        """
+        Handler for the packet types that have not been registered
+        """
+        print('Unknown routing for packet with type {:02x}'.format(packet.type))
 
     def register(self, fun, type):
         """
@@ -252,3 +314,13 @@ class LDPRouter:
           type: type of the packets to handle
         """
         self.__registrations[type] = fun
+
+    def register_map(self, funs):
+        """
+        Register several packet handlers at once
+
+        Args:
+          funs (dict): packet handler functions, indexed by the type of the packets to handle
+        """
+        for type, fun in funs.items():
+            self.__registrations[type] = fun
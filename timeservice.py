@@ -30,6 +30,9 @@ __email__ = 'daniel@destevez.net'
 import datetime
 import struct
 
+_DESCRIPTOR_HEADER = struct.Struct('>BB')
+_TIMESTAMP = struct.Struct('>Q')
+
 class TimeService:
     """
     Packet handler for Outernet time service
@@ -54,18 +57,21 @@ class TimeService:
         Args:
           packet (LDP): the LDP time packet
         """
-        payload = packet.payload
-        while len(payload) > 2:
-            desc_id, desc_len = struct.unpack('>BB', payload[0:2])
-            if desc_len > len(payload) - 2:
+        payload = memoryview(packet.payload)
+        pos = 0
+        end = len(payload)
+        while end - pos > 2:
+            desc_id, desc_len = _DESCRIPTOR_HEADER.unpack_from(payload, pos)
+            pos += _DESCRIPTOR_HEADER.size
+            if desc_len > end - pos:
                 break
-            data = payload[2:desc_len+2]
-            payload = payload[desc_len+2:]
+            data = payload[pos:pos+desc_len]
+            pos += desc_len
             if desc_id == 0x01:
                 server_id = str(data, 'utf-8')
                 print('[Time service] Server ID: {}'.format(server_id))
             elif desc_id == 0x02 and len(data) == 8:
-                timestamp = datetime.datetime.utcfromtimestamp(struct.unpack('>Q', data)[0])
+                timestamp = datetime.datetime.utcfromtimestamp(_TIMESTAMP.unpack_from(data, 0)[0])
                 print('[Time service] Server time: {} UTC'.format(timestamp))
             else:
                 print('[Time service] Unknown descriptor {:02x}'.format(desc_id))